@@ -1,23 +1,107 @@
 import os
+import logging
 from descope import DescopeClient
 from flask import Flask, request, jsonify, render_template
 from flask_cors import CORS
 from dotenv import load_dotenv
+import jwt
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import google_auth_httplib2
+import httplib2
 import datetime
+import functools
+import hashlib
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 
 load_dotenv()
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app)
 
 descope_client = DescopeClient(project_id=os.getenv('DESCOPE_PROJECT_ID'))
 DESCOPE_PROJECT_ID = os.getenv('DESCOPE_PROJECT_ID')
 DESCOPE_MANAGEMENT_KEY = os.getenv('DESCOPE_MANAGEMENT_KEY')
+_DESCOPE_HEADERS = {"Authorization": f"Bearer {DESCOPE_PROJECT_ID}:{DESCOPE_MANAGEMENT_KEY}"}
+_DESCOPE_TOKEN_URL = "https://api.descope.com/v1/mgmt/user/provider/token"
+_DESCOPE_JWKS_URL = f"https://api.descope.com/v2/keys/{DESCOPE_PROJECT_ID}"
 
 HF_MODEL = "sshleifer/distilbart-cnn-12-6"
+_HF_URL = f"https://api-inference.huggingface.co/models/{HF_MODEL}"
+_HF_HEADERS = {"Authorization": f"Bearer {os.getenv('HUGGINGFACE_API_KEY')}"}
+# distilbart only reads ~1024 input tokens, so larger contexts are wasted bytes
+MAX_DOC_CHARS = 4096
+MAX_CONTEXT_CHARS = 8192
+# Below this many characters of real text a briefing isn't worth an HF call
+MIN_CONTEXT_CHARS = 200
+
+_descope_pool = ThreadPoolExecutor(max_workers=4)
+
+# Provider tokens keyed by (login_id, provider) -> (expiration epoch, token data)
+_token_cache: dict[tuple[str, str], tuple[float, dict]] = {}
+_token_cache_lock = threading.Lock()
+TOKEN_EXPIRY_MARGIN = 60
+
+# Descope session signing keys by kid, used to verify JWTs locally. Refreshed after
+# JWKS_TTL, or early (at most every JWKS_MIN_REFRESH seconds) when a kid is unknown.
+_descope_jwks: dict = {}
+_descope_jwks_fetched_at = 0.0
+_descope_jwks_lock = threading.Lock()
+JWKS_TTL = 3600
+JWKS_MIN_REFRESH = 60
+# Short (connect, read) timeout so a slow JWKS refresh can't stall session validation
+JWKS_TIMEOUT = (3.05, 5)
+# Clock-skew allowance for exp/iat/nbf, matching the Descope SDK's default
+JWT_LEEWAY = 5
+
+# Last calendar listing per (access token, timeMin) -> (etag, events), for If-None-Match.
+# Only the current minute's entries are kept, since older timeMin values never recur.
+_cal_etag: dict[tuple[str, str], tuple[str, list]] = {}
+_cal_etag_lock = threading.Lock()
+
+_search_pool = ThreadPoolExecutor(max_workers=4)
+_drive_download_pool = ThreadPoolExecutor(max_workers=6)
+
+# Agent runs happen in the background; /trigger-agent returns a job id to poll.
+# Jobs map job_id -> (future, finished_at) and are evicted JOB_TTL seconds after finishing.
+_executor = ThreadPoolExecutor(max_workers=8)
+_jobs: dict[str, tuple[Future, float | None]] = {}
+_jobs_lock = threading.Lock()
+JOB_TTL = 3600
+# Pending/running job per login_id; new triggers are refused while one exists
+_active_jobs_by_login: dict[str, str] = {}
+MAX_PENDING_JOBS = 32
+
+# (connect, read) timeouts for outbound calls; HF gets longer for model cold starts
+DEFAULT_TIMEOUT = (3.05, 30)
+HF_TIMEOUT = (3.05, 60)
+
+# Shared session so keep-alive connections are reused across outbound calls
+SESSION = requests.Session()
+adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=2, backoff_factor=0.2))
+SESSION.mount("https://", adapter)
+
+
+def _warm_up_hf_model():
+    # Trigger the model load so the first real briefing doesn't hit a cold start
+    try:
+        SESSION.post(_HF_URL, headers=_HF_HEADERS,
+                     json={"inputs": "warmup", "parameters": {"max_new_tokens": 1}}, timeout=2)
+    except Exception as e:
+        logger.debug("Hugging Face warmup request failed: %s", e)
+
+
+_executor.submit(_warm_up_hf_model)
 
 @app.route('/')
 def home():
@@ -29,14 +113,26 @@ def login():
 
 
 def get_tokens_for_user(login_id, provider):
-    url = f"https://api.descope.com/v1/mgmt/user/provider/token?loginId={login_id}&provider={provider}"
-    headers = {"Authorization": f"Bearer {DESCOPE_PROJECT_ID}:{DESCOPE_MANAGEMENT_KEY}"}
-    
-    response = requests.get(url, headers=headers)
+    key = (login_id, provider)
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+    if cached and cached[0] - TOKEN_EXPIRY_MARGIN > time.time():
+        return cached[1]
+
+    try:
+        response = SESSION.get(
+            _DESCOPE_TOKEN_URL,
+            params={"loginId": login_id, "provider": provider},
+            headers=_DESCOPE_HEADERS,
+            timeout=DEFAULT_TIMEOUT
+        )
+    except requests.RequestException as e:
+        logger.error("Error fetching tokens for %s: %s", provider, e)
+        return None
     
     if response.status_code == 200:
         data = response.json()
-        return {
+        token_data = {
             'provider': data['provider'],
             'providerUserId': data['providerUserId'],
             'accessToken': data['accessToken'],
@@ -44,33 +140,77 @@ def get_tokens_for_user(login_id, provider):
             'scopes': data['scopes'],
             'refreshToken': data.get('refreshToken')
         }
+        try:
+            expiration = float(token_data['expiration'])
+        except (TypeError, ValueError):
+            expiration = None
+        if expiration:
+            with _token_cache_lock:
+                _token_cache[key] = (expiration, token_data)
+        return token_data
     else:
-        print(f"Error fetching tokens for {provider}: {response.text}")
+        logger.error("Error fetching tokens for %s (%s): %s", provider, response.status_code,
+                     response.content[:512].decode('utf-8', errors='ignore'))
         return None
 
+@functools.lru_cache(maxsize=None)
+def _service(api, version):
+    # Uses the discovery documents bundled with googleapiclient, so no network fetch.
+    # The service is shared, so requests must be run with _execute_google_request.
+    return build(api, version, http=httplib2.Http(),
+                 cache_discovery=False, static_discovery=True)
+
+
+def _execute_google_request(creds, request):
+    # httplib2 is not thread-safe, so each request gets its own connection
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+    return request.execute(http=http)
+
+
 def get_upcoming_meetings(google_access_token):
     try:
         creds = Credentials(token=google_access_token)
-        service = build('calendar', 'v3', credentials=creds)
+        service = _service('calendar', 'v3')
 
-        now = datetime.datetime.utcnow().isoformat() + 'Z'
-        events_result = service.events().list(
+        # Truncated to the minute so repeat triggers send an identical query,
+        # which lets the If-None-Match etag check below hit
+        now = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:00Z")
+        list_request = service.events().list(
             calendarId='primary',
             timeMin=now,
             maxResults=5,
             singleEvents=True,
             orderBy='startTime'
-        ).execute()
+        )
+
+        cache_key = (google_access_token, now)
+        with _cal_etag_lock:
+            cached = _cal_etag.get(cache_key)
+        if cached:
+            list_request.headers['If-None-Match'] = cached[0]
+
+        try:
+            events_result = _execute_google_request(creds, list_request)
+        except HttpError as e:
+            if cached and e.resp.status == 304:
+                return cached[1]
+            raise
         
         events = events_result.get('items', [])
+        etag = events_result.get('etag')
+        if etag:
+            with _cal_etag_lock:
+                for key in [k for k in _cal_etag if k[1] != now]:
+                    del _cal_etag[key]
+                _cal_etag[cache_key] = (etag, events)
         return events
     except Exception as e:
-        print(f"Google Calendar API error: {e}")
+        logger.error("Google Calendar API error: %s", e)
         return []
 
 
 def generate_briefing(meeting_title, attendees, document_texts):
-    full_context = "\n---\n".join(document_texts)
+    full_context = "\n---\n".join(document_texts)[:MAX_CONTEXT_CHARS]
     
     prompt = f"""Meeting Title: {meeting_title}
 Attendees: {', '.join(attendees)}
@@ -81,49 +221,101 @@ Context:
 Provide a concise briefing summarizing the purpose, key points, action items, and potential questions.
 """
     
-    headers = {
-        "Authorization": f"Bearer {os.getenv('HUGGINGFACE_API_KEY')}"
-    }
-    
     payload = {
         "inputs": prompt,
         "parameters": {"max_new_tokens": 300}
     }
     
     try:
-        response = requests.post(
-            f"https://api-inference.huggingface.co/models/{HF_MODEL}",
-            headers=headers,
-            json=payload
+        response = SESSION.post(
+            _HF_URL,
+            headers=_HF_HEADERS,
+            json=payload,
+            timeout=HF_TIMEOUT
         )
         
         if response.status_code == 200:
             summary = response.json()[0]['summary_text']
             return summary
         else:
-            print(f"Hugging Face API error: {response.status_code}, {response.text}")
+            logger.error("Hugging Face API error: %s, %s", response.status_code, response.text)
             return "Error: Could not generate briefing."
     except Exception as e:
-        print(f"Error calling Hugging Face API: {e}")
+        logger.error("Error calling Hugging Face API: %s", e)
         return "Error: Could not generate briefing."
 
 
+def _fetch_descope_jwks():
+    response = SESSION.get(_DESCOPE_JWKS_URL, timeout=JWKS_TIMEOUT)
+    response.raise_for_status()
+    keys = {}
+    for k in response.json().get('keys', []):
+        try:
+            keys[k['kid']] = jwt.PyJWK(k).key
+        except (KeyError, ValueError, jwt.PyJWTError) as e:
+            logger.warning("Skipping unusable Descope signing key: %s", e)
+    return keys
+
+
+def _get_descope_signing_key(kid):
+    global _descope_jwks, _descope_jwks_fetched_at
+    with _descope_jwks_lock:
+        age = time.time() - _descope_jwks_fetched_at
+        refresh = age > JWKS_TTL or (kid not in _descope_jwks and age > JWKS_MIN_REFRESH)
+        if not refresh:
+            return _descope_jwks.get(kid)
+        # Claim the refresh so concurrent callers keep using the current keys
+        _descope_jwks_fetched_at = time.time()
+
+    # Fetch outside the lock; on failure the previous keys stay in place
+    try:
+        keys = _fetch_descope_jwks()
+    except Exception as e:
+        logger.warning("Could not fetch Descope signing keys: %s", e)
+    else:
+        with _descope_jwks_lock:
+            _descope_jwks = keys
+
+    with _descope_jwks_lock:
+        return _descope_jwks.get(kid)
+
+
 def validate_descope_session(session_token: str):
+    try:
+        kid = jwt.get_unverified_header(session_token).get('kid')
+    except jwt.PyJWTError as e:
+        logger.warning("Session validation failed: %s", e)
+        return None
+
+    signing_key = _get_descope_signing_key(kid)
+    if signing_key is not None:
+        try:
+            return jwt.decode(session_token, key=signing_key, algorithms=["RS256"],
+                              leeway=JWT_LEEWAY, options={"verify_aud": False})
+        except jwt.ImmatureSignatureError as e:
+            # Not a bad signature; let the SDK make the call on clock skew
+            logger.debug("Session token not yet valid locally, falling back to Descope: %s", e)
+        except jwt.PyJWTError as e:
+            logger.warning("Session validation failed: %s", e)
+            return None
+
+    # No usable local verification for this token, so let the Descope SDK validate it
     try:
         auth_info = descope_client.validate_session(session_token)
-        print("Session is valid. Auth info:", auth_info)
-        print(f"Available keys in auth_info: {list(auth_info.keys()) if isinstance(auth_info, dict) else 'Not a dict'}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Session is valid. Auth info: %s", auth_info)
+            logger.debug("Available keys in auth_info: %s", list(auth_info.keys()) if isinstance(auth_info, dict) else 'Not a dict')
         return auth_info
     except Exception as e:
-        print(f"Session validation failed: {e}")
+        logger.warning("Session validation failed: %s", e)
         return None
 
 
 @app.route('/validate-session', methods=['POST'])
 def validate_session():
-    print('Validate session endpoint hit')
+    logger.debug('Validate session endpoint hit')
     data = request.get_json()
-    print('Received data:', data)
+    logger.debug('Received data: %s', data)
     session_token = data.get('token')
 
     if not session_token:
@@ -132,15 +324,16 @@ def validate_session():
     user_details = validate_descope_session(session_token)
 
     if user_details:
-        print(f"Full session validation response: {user_details}")
-        print(f"Available keys: {user_details.keys()}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Full session validation response: %s", user_details)
+            logger.debug("Available keys: %s", list(user_details.keys()))
         
         # Try to access the correct user identifier
         # The JWT structure shows 'sub' contains the User ID
         user_id = user_details.get('sub')  # This is the User ID
         
         if user_id:
-            print(f"Validated user with User ID: {user_id}")
+            logger.info("Validated user with User ID: %s", user_id)
             return jsonify({"status": "success", "user": user_id})
         else:
             return jsonify({"error": "Could not extract user ID"}), 401
@@ -152,19 +345,24 @@ def search_drive_and_get_content(access_token, query):
     all_content = []
     try:
         creds = Credentials(token=access_token)
-        service = build('drive', 'v3', credentials=creds)
+        service = _service('drive', 'v3')
         
-        response = service.files().list(
-            q=f"name contains '{query}' and mimeType != 'application/vnd.google-apps.folder'",
+        # Escape backslashes and quotes so titles like O'Brien form a valid query
+        safe_query = query.replace("\\", "\\\\").replace("'", "\\'")
+        list_request = service.files().list(
+            q=f"name contains '{safe_query}' and mimeType != 'application/vnd.google-apps.folder'",
             pageSize=3,
-            fields="files(id, name, mimeType)"
-        ).execute()
+            fields="files(id,name,mimeType)",
+            supportsAllDrives=False
+        )
+        response = _execute_google_request(creds, list_request)
         
         files = response.get('files', [])
         if not files:
-            print(f"No files found in Drive for query: {query}")
+            logger.info("No files found in Drive for query: %s", query)
             return []
 
+        requests_to_run = []
         for item in files:
             file_id = item['id']
             mime_type = item['mimeType']
@@ -173,13 +371,17 @@ def search_drive_and_get_content(access_token, query):
                 request = service.files().export(fileId=file_id, mimeType='text/plain')
             else:
                 request = service.files().get_media(fileId=file_id)
-            
-            content = request.execute()
-            all_content.append(content.decode('utf-8', errors='ignore'))
+            requests_to_run.append(request)
+
+        # Drive does not support media downloads in batch requests, so
+        # download the files concurrently instead of one after another
+        contents = _drive_download_pool.map(lambda r: _execute_google_request(creds, r), requests_to_run)
+        for content in contents:
+            all_content.append(content.decode('utf-8', errors='ignore')[:MAX_DOC_CHARS])
             
         return all_content
     except Exception as e:
-        print(f"An error occurred with Google Drive API: {e}")
+        logger.error("An error occurred with Google Drive API: %s", e)
         return []
 
 
@@ -191,10 +393,15 @@ def search_notion_and_get_content(access_token, query):
     }
     search_payload = {"query": query}
     
-    response = requests.post("https://api.notion.com/v1/search", json=search_payload, headers=headers)
+    try:
+        response = SESSION.post("https://api.notion.com/v1/search", json=search_payload, headers=headers,
+                                timeout=DEFAULT_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error("Error searching Notion: %s", e)
+        return []
     
     if response.status_code != 200:
-        print(f"Error searching Notion: {response.text}")
+        logger.error("Error searching Notion: %s", response.text)
         return []
         
     results = response.json().get('results', [])
@@ -204,51 +411,68 @@ def search_notion_and_get_content(access_token, query):
 
 
 def run_catalyst_for_user(login_id):
-    print(f"--- Running Catalyst Agent for user: {login_id} ---")
+    logger.info("--- Running Catalyst Agent for user: %s ---", login_id)
 
-    # Get tokens for each provider separately
-    google_token_data = get_tokens_for_user(login_id, 'google')
-    notion_token_data = get_tokens_for_user(login_id, 'notion')
-    slack_token_data = get_tokens_for_user(login_id, 'slack')
+    # Fetch tokens for each provider in parallel
+    providers = ('google', 'notion', 'slack')
+    futures = {p: _descope_pool.submit(get_tokens_for_user, login_id, p) for p in providers}
+    google_token_data, notion_token_data, slack_token_data = (futures[p].result() for p in providers)
 
     if not google_token_data:
-        print("User has not connected Google. Cannot get meetings.")
+        logger.info("User has not connected Google. Cannot get meetings.")
         return
         
     google_token = google_token_data['accessToken']
     meetings = get_upcoming_meetings(google_token)
     
     if not meetings:
-        print("No upcoming meetings to process.")
+        logger.info("No upcoming meetings to process.")
         return
 
     next_meeting = meetings[0]
     title = next_meeting.get('summary', 'No Title')
-    attendees = [attendee.get('email') for attendee in next_meeting.get('attendees', [])]
+    attendees = tuple(a['email'] for a in next_meeting.get('attendees', ()) if a.get('email'))
 
     all_context_docs = []
-    search_query = title.split(' ')[0]
-
-    # Use Google Drive
-    drive_content = search_drive_and_get_content(google_token, search_query)
-    all_context_docs.extend(drive_content)
+    search_query = title.partition(' ')[0]
+    if title == 'No Title' or len(search_query) < 3:
+        logger.info("Title too generic, skipping context search")
+        return
 
-    # Use Notion if available
+    # Search Google Drive and Notion (if available) concurrently
+    drive_future = _search_pool.submit(search_drive_and_get_content, google_token, search_query)
+    notion_future = None
     if notion_token_data:
         notion_token = notion_token_data['accessToken']
-        notion_content = search_notion_and_get_content(notion_token, search_query)
-        all_context_docs.extend(notion_content)
+        notion_future = _search_pool.submit(search_notion_and_get_content, notion_token, search_query)
+
+    all_context_docs.extend(drive_future.result())
+    if notion_future:
+        all_context_docs.extend(notion_future.result())
     
     if not all_context_docs:
-        print("Found no relevant documents. Nothing to summarize.")
+        logger.info("Found no relevant documents. Nothing to summarize.")
+        return
+
+    stripped = (d.strip() for d in all_context_docs)
+    useful_chars = sum(len(d) for d in stripped if d and d != "Untitled")
+    if useful_chars < MIN_CONTEXT_CHARS:
+        logger.info("Found too little context to generate a briefing. Nothing to summarize.")
         return
 
-    print("Generating AI summary...")
-    briefing = generate_briefing(title, attendees, all_context_docs)
+    # Drop documents with identical text so they aren't sent to HF twice
+    seen = set()
+    deduped_docs = []
+    for doc in all_context_docs:
+        digest = hashlib.blake2b(doc.encode('utf-8', errors='ignore'), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            deduped_docs.append(doc)
+
+    logger.info("Generating AI summary...")
+    briefing = generate_briefing(title, attendees, deduped_docs)
     
-    print("--- BRIEFING ---")
-    print(briefing)
-    print("----------------")
+    logger.info("--- BRIEFING ---\n%s\n----------------", briefing)
     
     # Send to Slack if available
     if slack_token_data:
@@ -256,27 +480,77 @@ def run_catalyst_for_user(login_id):
         slack_user_id = slack_token_data['providerUserId']
         send_slack_message(slack_token, slack_user_id, briefing)
     else:
-        print("Slack is not connected for this user.")
+        logger.info("Slack is not connected for this user.")
+
+    logger.info("--- Agent run for %s complete. ---", login_id)
+
+
+def _on_job_done(job_id, login_id, future):
+    error = future.exception()
+    if error:
+        logger.error("Agent job %s failed", job_id, exc_info=error)
+    with _jobs_lock:
+        _jobs[job_id] = (future, time.time())
+        if _active_jobs_by_login.get(login_id) == job_id:
+            del _active_jobs_by_login[login_id]
 
-    print(f"--- Agent run for {login_id} complete. ---")
+
+def _evict_expired_jobs():
+    cutoff = time.time() - JOB_TTL
+    with _jobs_lock:
+        expired = [job_id for job_id, (_, finished_at) in _jobs.items()
+                   if finished_at is not None and finished_at < cutoff]
+        for job_id in expired:
+            del _jobs[job_id]
 
 
 @app.route('/trigger-agent', methods=['POST'])
 def trigger_agent():
     data = request.get_json()
-    print('Trigger agent called with:', data)
+    logger.debug('Trigger agent called with: %s', data)
 
     login_id = data.get('loginId')
     if not login_id:
         return jsonify({"error": "loginId is required"}), 400
         
-    run_catalyst_for_user(login_id)
-    return jsonify({"status": f"Agent run started for {login_id}"})
+    _evict_expired_jobs()
+    with _jobs_lock:
+        active_job_id = _active_jobs_by_login.get(login_id)
+        if active_job_id:
+            return jsonify({"error": f"Agent run already in progress for {login_id}",
+                            "job_id": active_job_id}), 429
+        if len(_active_jobs_by_login) >= MAX_PENDING_JOBS:
+            return jsonify({"error": "Too many agent runs in progress, try again later"}), 503
+
+        job_id = uuid.uuid4().hex
+        future = _executor.submit(run_catalyst_for_user, login_id)
+        _jobs[job_id] = (future, None)
+        _active_jobs_by_login[login_id] = job_id
+    future.add_done_callback(functools.partial(_on_job_done, job_id, login_id))
+    return jsonify({"status": f"Agent run started for {login_id}", "job_id": job_id})
+
+
+@app.route('/trigger-agent/<job_id>', methods=['GET'])
+def agent_job_status(job_id):
+    _evict_expired_jobs()
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+
+    future = job[0]
+    if not future.done():
+        return jsonify({"job_id": job_id, "status": "running"})
+
+    error = future.exception()
+    if error:
+        return jsonify({"job_id": job_id, "status": "failed", "error": str(error)})
+    return jsonify({"job_id": job_id, "status": "done"})
 
 
 def send_slack_message(access_token, user_id, message_text):
     if not user_id:
-        print("Slack User ID is missing. Cannot send DM.")
+        logger.warning("Slack User ID is missing. Cannot send DM.")
         return
 
     url = "https://slack.com/api/chat.postMessage"
@@ -291,9 +565,14 @@ def send_slack_message(access_token, user_id, message_text):
         "unfurl_media": False
     }
     
-    response = requests.post(url, headers=headers, json=payload)
-    
-    if response.json().get('ok'):
-        print("Slack message sent successfully!")
+    try:
+        response = SESSION.post(url, headers=headers, json=payload, timeout=DEFAULT_TIMEOUT)
+        body = response.json()
+    except (requests.RequestException, ValueError) as e:
+        logger.error("Error sending Slack message: %s", e)
+        return
+
+    if body.get('ok'):
+        logger.info("Slack message sent successfully!")
     else:
-        print(f"Error sending Slack message: {response.json().get('error')}")
+        logger.error("Error sending Slack message: %s", body.get('error'))